@@ -12,4 +12,15 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import os
+
 __version__ = "6.1.1"
+
+if os.environ.get("FINK_PROFILE"):
+    # line-by-line profiling of decorated functions (see `line_profiler`)
+    from line_profiler import profile
+else:
+
+    def profile(func):
+        """No-op replacement for `line_profiler.profile`, used in production"""
+        return func
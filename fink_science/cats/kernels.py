@@ -0,0 +1,90 @@
+# Copyright 2024 AstroLab Software
+# Author: Andre Santos, Bernardo Fraga, Clecio de Bom
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import numpy as np
+
+from numba import njit, prange
+
+# Shape of a light curve for the CATS model. Numba freezes global
+# integers at compile time, so kernels are specialised for these values.
+MAXLEN = 395
+NCHANNELS = 4
+
+
+@njit(cache=True, error_model="numpy")
+def _norm_factors(values):
+    """Return (shift, scale) such that (values - shift) / scale = norm_column(values)"""
+    if len(values) == 1:
+        return values[0] - 1.0, 1.0
+    vmin = np.min(values)
+    return vmin, np.max(values) - vmin
+
+
+@njit(
+    "void(float64[::1], float64[::1], float64[::1], int16[::1], "
+    "int64[::1], float32[:, :, ::1])",
+    parallel=True,
+    cache=True,
+    error_model="numpy",
+)
+def build_lc(mjd_flat, flux_flat, err_flat, filt_flat, offsets, out):
+    """Normalise and pad light curves into the CATS input tensor
+
+    Alert `i` spans `flat[offsets[i]:offsets[i + 1]]` in all the
+    concatenated inputs. Channels of `out[i]` are (mjd, flux, error, band):
+    mjd is shifted to start at 0, flux and error are normalised
+    as in `norm_column`, and the tail is padded with -999 (0 for band).
+
+    Parameters
+    ----------
+    mjd_flat, flux_flat, err_flat: np.array of float64
+        Concatenated MJD, flux and flux error of all alerts
+    filt_flat: np.array of int16
+        Concatenated band codes of all alerts
+    offsets: np.array of int64
+        Offsets of each alert in the flat arrays (size N + 1)
+    out: np.array of float32
+        C-contiguous output array of shape (N, MAXLEN, NCHANNELS), filled
+        in place. It is passed as is to the model: no further copy is needed.
+    """
+    if out.shape[1] != MAXLEN or out.shape[2] != NCHANNELS:
+        raise ValueError("out must have shape (N, MAXLEN, NCHANNELS)")
+
+    for i in prange(out.shape[0]):
+        start, stop = offsets[i], offsets[i + 1]
+
+        # As for `keras.utils.pad_sequences(truncating="pre")`,
+        # only the last MAXLEN measurements are kept
+        nvalues = min(stop - start, MAXLEN)
+        first = stop - nvalues
+
+        if nvalues > 0:
+            # Normalisation uses the full light curve
+            mjd0 = mjd_flat[start]
+            flux_shift, flux_scale = _norm_factors(flux_flat[start:stop])
+            err_shift, err_scale = _norm_factors(err_flat[start:stop])
+
+            # Write the 4 channels of each timestep together
+            for j in range(nvalues):
+                k = first + j
+                out[i, j, 0] = mjd_flat[k] - mjd0
+                out[i, j, 1] = (flux_flat[k] - flux_shift) / flux_scale
+                out[i, j, 2] = (err_flat[k] - err_shift) / err_scale
+                out[i, j, 3] = filt_flat[k]
+
+        for j in range(nvalues, MAXLEN):
+            out[i, j, 0] = -999.0
+            out[i, j, 1] = -999.0
+            out[i, j, 2] = -999.0
+            out[i, j, 3] = 0.0
@@ -12,19 +12,237 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from line_profiler import profile
+from fink_science import profile
 
 import os
+import tempfile
+
 import numpy as np
 import pandas as pd
 
+from pyspark.sql import SparkSession
 from pyspark.sql.functions import pandas_udf, PandasUDFType
 from pyspark.sql.types import ArrayType, FloatType
 
 from fink_science import __file__
-from fink_science.cats.utilities import norm_column
+from fink_science.cats.kernels import build_lc, MAXLEN, NCHANNELS
 from fink_science.tester import spark_unit_tests
 
+DEFAULT_MODEL_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "data/models/cats_models/cats_small_nometa_serial.keras",
+)
+
+# Number of broad classes of the default model
+NCLASSES = 5
+
+# ELAsTiCC uses `Y`, and Rubin `y`, for the same band
+FILTER_DICT = {"u": 1, "g": 2, "r": 3, "i": 4, "z": 5, "Y": 6, "y": 6}
+
+# Lookup table from the ASCII code of the filter name to the band code
+# (0 for unknown names)
+_FILTER_LUT = np.zeros(256, dtype=np.int16)
+_FILTER_LUT[[ord(k) for k in FILTER_DICT]] = list(FILTER_DICT.values())
+
+# Maximum number of light curves sent to the model at once: activations
+# of the Conv1D layers take about 400 kB per light curve
+CHUNK_SIZE = 512
+
+# Models already loaded by this Python worker, keyed by their path
+_MODEL_CACHE = {}
+
+
+def _load_model(model_path: str, model_bytes: bytes = None):
+    """Load a Keras model for inference, from its file or from its content"""
+    import tensorflow as tf
+
+    if model_bytes is None:
+        return tf.keras.models.load_model(model_path, compile=False)
+
+    # Keras loads models from files only
+    suffix = os.path.splitext(model_path)[1]
+    with tempfile.NamedTemporaryFile(suffix=suffix) as f:
+        f.write(model_bytes)
+        f.flush()
+        return tf.keras.models.load_model(f.name, compile=False)
+
+
+def _get_model(model_path: str, model_b=None):
+    """Load a pre-trained model once per Python worker
+
+    Parameters
+    ----------
+    model_path: str
+        Path to the pre-trained Keras model
+    model_b: pyspark.Broadcast, optional
+        Content of the model file, broadcasted by Spark. If given, the model
+        is loaded from it instead of `model_path`.
+
+    Returns
+    -------
+    out: tf.keras.Model
+        The model, shared between all subsequent calls with the same path
+        (or broadcast variable)
+    """
+    if model_b is None:
+        key = model_path
+    else:
+        key = "broadcast:{}".format(model_b.id)
+
+    model = _MODEL_CACHE.get(key)
+    if model is None:
+        model_bytes = None if model_b is None else model_b.value
+        model = _load_model(model_path, model_bytes)
+        _MODEL_CACHE[key] = model
+    return model
+
+
+def _flatten(col: pd.Series) -> np.array:
+    """Concatenate a column of arrays into a float64 array"""
+    return np.concatenate(col.to_numpy()).astype(np.float64)
+
+
+def _unknown_filter(name: str) -> str:
+    """Error message for a filter name not in FILTER_DICT"""
+    return "Unknown filter name {!r}, expected one of {}".format(
+        str(name), list(FILTER_DICT)
+    )
+
+
+def _build_lc(
+    midpointTai: pd.Series,
+    psFlux: pd.Series,
+    psFluxErr: pd.Series,
+    filterName: pd.Series,
+) -> tuple:
+    """Build the (N, MAXLEN, NCHANNELS) input array of the CATS model
+
+    Returns
+    -------
+    lc: np.array of float32
+        Normalised and padded light curves
+    has_obs: np.array of bool
+        True for the alerts with at least one measurement
+
+    Examples
+    --------
+    >>> mjd = pd.Series([[60000.0, 60001.0]])
+    >>> flux = pd.Series([[10.0, 20.0]])
+    >>> err = pd.Series([[1.0, 2.0]])
+    >>> lc, has_obs = _build_lc(mjd, flux, err, pd.Series([["Y", "y"]]))
+    >>> lc[0, :2, 3].tolist()
+    [6.0, 6.0]
+    >>> _build_lc(mjd, flux, err, pd.Series([["g", "w"]]))
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown filter name 'w', expected one of ['u', 'g', 'r', 'i', 'z', 'Y', 'y']
+    >>> _build_lc(mjd, flux, err, pd.Series([["g", "rr"]]))
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown filter name 'rr', expected one of ['u', 'g', 'r', 'i', 'z', 'Y', 'y']
+    """
+    # All columns of an alert have the same length: share the offsets
+    mjd_arr = midpointTai.to_numpy()
+    offsets = np.zeros(len(mjd_arr) + 1, dtype=np.int64)
+    np.cumsum(
+        np.fromiter(map(len, mjd_arr), dtype=np.int64, count=len(mjd_arr)),
+        out=offsets[1:],
+    )
+
+    mjd_flat = _flatten(midpointTai)
+    flux_flat = _flatten(psFlux)
+    err_flat = _flatten(psFluxErr)
+
+    filt_names = np.concatenate(filterName.to_numpy())
+    for flat in (flux_flat, err_flat, filt_names):
+        if len(flat) != offsets[-1]:
+            raise ValueError("All light curve columns must have the same length")
+
+    # Decode all (one character) filter names of the batch with one lookup
+    names = "".join(filt_names).encode("ascii")
+    if len(names) != offsets[-1]:
+        # longer (or empty) names would shift all the following ones
+        bad = next(name for name in filt_names if len(name) != 1)
+        raise ValueError(_unknown_filter(bad))
+
+    filt_flat = _FILTER_LUT[np.frombuffer(names, dtype=np.uint8)]
+    unknown = filt_flat == 0
+    if unknown.any():
+        raise ValueError(_unknown_filter(filt_names[np.argmax(unknown)]))
+
+    # Normalise and pad all light curves at once
+    lc = np.empty((len(mjd_arr), MAXLEN, NCHANNELS), dtype=np.float32)
+    build_lc(mjd_flat, flux_flat, err_flat, filt_flat, offsets, lc)
+
+    return lc, np.diff(offsets) > 0
+
+
+def _run_model(NN, lc: np.array, chunk_size: int = CHUNK_SIZE) -> np.array:
+    """Run the model on `lc`, `chunk_size` light curves at a time
+
+    Examples
+    --------
+    >>> NN = _get_model(DEFAULT_MODEL_PATH)
+    >>> lc = np.full((5, MAXLEN, NCHANNELS), -999.0, dtype=np.float32)
+    >>> lc[:, 0] = [[0.0, 0.5, 0.2, 2.0], [0.0, 1.0, 1.0, 3.0], [0.0, 0.3, 0.7, 1.0],
+    ...             [0.0, 0.9, 0.1, 4.0], [0.0, 0.1, 0.4, 6.0]]
+    >>> lc[:, 1:, 3] = 0.0
+    >>> out = _run_model(NN, lc, chunk_size=2)
+    >>> out.shape
+    (5, 5)
+    >>> bool(np.allclose(out, NN(lc, training=False).numpy(), atol=1e-6))
+    True
+    """
+    outs = [
+        NN(lc[start : start + chunk_size], training=False).numpy()
+        for start in range(0, len(lc), chunk_size)
+    ]
+    return np.concatenate(outs)
+
+
+def _predict(
+    midpointTai: pd.Series,
+    psFlux: pd.Series,
+    psFluxErr: pd.Series,
+    filterName: pd.Series,
+    model_path: str,
+    model_b=None,
+) -> pd.Series:
+    """Return the predictions of a CATS model, one array per alert
+
+    See `predict_nn` for the columns, and `_get_model`
+    for `model_path` and `model_b`. Alerts without
+    measurements get -1 for all classes.
+
+    Examples
+    --------
+    >>> mjd = pd.Series([[60000.0, 60001.5, 60004.0], [], [60002.0]])
+    >>> flux = pd.Series([[10.0, 25.0, 18.0], [], [12.0]])
+    >>> err = pd.Series([[1.0, 1.5, 1.2], [], [0.8]])
+    >>> filt = pd.Series([["g", "r", "g"], [], ["i"]])
+    >>> preds = _predict(mjd, flux, err, filt, DEFAULT_MODEL_PATH)
+    >>> preds[1].tolist()
+    [-1.0, -1.0, -1.0, -1.0, -1.0]
+    >>> [bool(np.isclose(preds[i].sum(), 1.0)) for i in (0, 2)]
+    [True, True]
+    """
+    if not midpointTai.apply(len).any():
+        # No measurements in the batch: skip the model entirely
+        return pd.Series([[-1.0] * NCLASSES] * len(midpointTai))
+
+    lc, has_obs = _build_lc(midpointTai, psFlux, psFluxErr, filterName)
+    if not has_obs.all():
+        lc = lc[has_obs]
+
+    NN = _get_model(model_path, model_b)
+    out = _run_model(NN, lc)
+
+    # Alerts without measurements are not sent to the model
+    preds = np.full((len(has_obs), out.shape[1]), -1.0, dtype=out.dtype)
+    preds[has_obs] = out
+
+    return pd.Series(list(preds))
+
 
 @pandas_udf(ArrayType(FloatType()), PandasUDFType.SCALAR)
 @profile
@@ -98,59 +316,74 @@ def predict_nn(
     >>> df.filter(df['argmax'] == 0).count()
     49
     """
-    import tensorflow as tf
-    from tensorflow import keras
-
-    filter_dict = {"u": 1, "g": 2, "r": 3, "i": 4, "z": 5, "Y": 6}
-
-    mjd = []
-    filters = []
-
-    for i, mjds in enumerate(midpointTai):
-        if len(mjds) > 0:
-            filters.append(
-                np.array([filter_dict[f] for f in filterName.to_numpy()[i]]).astype(
-                    np.int16
-                )
-            )
-
-            mjd.append(mjds - mjds[0])
+    if model is None:
+        # Load pre-trained model
+        model_path = DEFAULT_MODEL_PATH
+    else:
+        model_path = model.iloc[0]
 
-    flux = psFlux.apply(lambda x: norm_column(x))
-    error = psFluxErr.apply(lambda x: norm_column(x))
+    return _predict(midpointTai, psFlux, psFluxErr, filterName, model_path)
 
-    flux = keras.utils.pad_sequences(
-        flux, maxlen=395, value=-999.0, padding="post", dtype=np.float32
-    )
 
-    mjd = keras.utils.pad_sequences(
-        mjd, maxlen=395, value=-999.0, padding="post", dtype=np.float32
-    )
+def predict_nn_broadcast(model_path: str = None):
+    """Return a version of `predict_nn` using a model broadcasted by Spark
 
-    error = keras.utils.pad_sequences(
-        error, maxlen=395, value=-999.0, padding="post", dtype=np.float32
-    )
+    The model file is read once on the driver, and sent once to each
+    executor, instead of being read from the local filesystem by each
+    executor.
 
-    band = keras.utils.pad_sequences(
-        filters, maxlen=395, value=0.0, padding="post", dtype=np.uint8
-    )
-
-    lc = np.concatenate(
-        [mjd[..., None], flux[..., None], error[..., None], band[..., None]], axis=-1
-    )
+    Parameters
+    ----------
+    model_path: str, optional
+        Path (on the driver) to the pre-trained Keras model.
+        Default is the model distributed with fink-science.
 
-    if model is None:
-        # Load pre-trained model
-        curdir = os.path.dirname(os.path.abspath(__file__))
-        model_path = curdir + "/data/models/cats_models/cats_small_nometa_serial.keras"
-    else:
-        model_path = model.to_numpy()[0]
+    Returns
+    -------
+    out: pandas_udf
+        Spark pandas UDF taking the same columns as `predict_nn`
+        (without `model`)
 
-    NN = tf.keras.models.load_model(model_path)
+    Examples
+    --------
+    >>> from fink_utils.spark.utils import concat_col
+    >>> from pyspark.sql import functions as F
+    >>> df = spark.read.format('parquet').load(elasticc_alert_sample)
 
-    preds = NN.predict([lc])
+    >>> what = ['midPointTai', 'psFlux', 'psFluxErr', 'filterName']
+    >>> prefix = 'c'
+    >>> what_prefix = [prefix + i for i in what]
+    >>> for colname in what:
+    ...     df = concat_col(
+    ...         df, colname, prefix=prefix,
+    ...         current='diaSource', history='prvDiaForcedSources')
 
-    return pd.Series(list(preds))
+    >>> args = [F.col(i) for i in what_prefix]
+    >>> df = df.withColumn('preds', predict_nn_broadcast()(*args))
+    >>> df = df.withColumn('argmax', F.expr('array_position(preds, array_max(preds)) - 1'))
+    >>> df.filter(df['argmax'] == 0).count()
+    49
+    """
+    if model_path is None:
+        model_path = DEFAULT_MODEL_PATH
+
+    with open(model_path, "rb") as f:
+        model_bytes = f.read()
+
+    spark = SparkSession.builder.getOrCreate()
+    model_b = spark.sparkContext.broadcast(model_bytes)
+
+    @pandas_udf(ArrayType(FloatType()), PandasUDFType.SCALAR)
+    def predict_nn_b(
+        midpointTai: pd.Series,
+        psFlux: pd.Series,
+        psFluxErr: pd.Series,
+        filterName: pd.Series,
+    ) -> pd.Series:
+        """Same as `predict_nn`, with the model taken from a broadcast variable"""
+        return _predict(midpointTai, psFlux, psFluxErr, filterName, model_path, model_b)
+
+    return predict_nn_b
 
 
 if __name__ == "__main__":
@@ -14,7 +14,7 @@
 # limitations under the License.
 """Implementation of the paper: ELEPHANT: ExtragaLactic alErt Pipeline for Hostless AstroNomical Transients https://arxiv.org/abs/2404.18165"""
 
-from line_profiler import profile
+from fink_science import profile
 from typing import Dict, Tuple
 import numpy as np
 import astropy.table as at
@@ -12,7 +12,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from line_profiler import profile
+from fink_science import profile
 
 from pyspark.sql.functions import pandas_udf, PandasUDFType
 from pyspark.sql.types import StringType, DoubleType
@@ -17,7 +17,7 @@ from pyspark.sql.types import DoubleType, StringType
 
 import pandas as pd
 import numpy as np
-from line_profiler import profile
+from fink_science import profile
 
 import os
 import pickle
@@ -20,7 +20,7 @@ import sys
 import time
 import datetime
 
-from line_profiler import profile
+from fink_science import profile
 
 from pyspark.sql import SparkSession
 import pyspark.sql.functions as F
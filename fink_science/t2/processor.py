@@ -12,9 +12,10 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from line_profiler import profile
+from fink_science import profile
 
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 from pyspark.sql.functions import pandas_udf, PandasUDFType
 from pyspark.sql.types import StringType, FloatType, MapType
@@ -31,10 +32,15 @@ from fink_science import __file__
 from fink_science.t2.utilities import get_lite_model
 from fink_science.t2.utilities import apply_selection_cuts_ztf
 from fink_science.t2.utilities import extract_maxclass
+from fink_science.t2.utilities import drop_invalid_measurements
+from fink_science.t2.utilities import get_gp_threads
 from fink_science.t2.utilities import T2_COLS
 
 from fink_science.tester import spark_unit_tests
 
+# Probabilities for alerts not classified. Shared by all alerts: never mutate it.
+_DEFAULT_T2 = dict.fromkeys(T2_COLS, -1.0)
+
 
 @pandas_udf(StringType(), PandasUDFType.SCALAR)
 def maxclass(dic):
@@ -109,16 +115,20 @@ def t2(
     >>> df.filter(df['maxClass'] == 'SNIa').count()
     0
     """
-    default = {k: -1.0 for k in T2_COLS}
-    to_return = np.array([default for i in range(len(jd))])
+    default = _DEFAULT_T2
+    to_return = [default] * len(jd)
 
     mask = apply_selection_cuts_ztf(magpsf, cdsxmatch, jd, jdstarthist, roid)
+    mask_arr = mask.to_numpy()
 
-    if len(jd[mask]) == 0:
+    if not mask_arr.any():
         return pd.Series(to_return)
 
     ZTF_FILTER_MAP = {1: "ztfg", 2: "ztfr", 3: "ztfi"}
 
+    # One bit per band
+    ZTF_FILTER_BITS = {"ztfg": 0b001, "ztfr": 0b010, "ztfi": 0b100}
+
     ZTF_PB_WAVELENGTHS = {
         "ztfg": 4804.79,
         "ztfr": 6436.92,
@@ -126,10 +136,25 @@ def t2(
     }
 
     # Rescale dates to _start_ at 0
-    dates = jd.apply(lambda x: [x[0] - i for i in x])
+    dates = jd.apply(lambda x: x[0] - np.asarray(x, dtype=np.float64))
+
+    # Remove invalid measurements (NaN) before exploding alerts
+    keep, (magpsf, sigmapsf, dates, fid) = drop_invalid_measurements(
+        mask_arr, magpsf, sigmapsf, dates, fid
+    )
+    if not keep.any():
+        return pd.Series(to_return)
+
+    candid_keep = candid[keep]
 
     pdf = format_data_as_snana(
-        dates, magpsf, sigmapsf, fid, candid, mask, filter_conversion_dic=ZTF_FILTER_MAP
+        dates,
+        magpsf,
+        sigmapsf,
+        fid,
+        candid_keep,
+        np.ones(len(candid_keep), dtype=bool),
+        filter_conversion_dic=ZTF_FILTER_MAP,
     )
 
     pdf = pdf.rename(
@@ -142,27 +167,28 @@ def t2(
         }
     )
 
-    pdf = pdf.dropna()
     pdf = pdf.reset_index()
 
+    # Partition measurements per object once
+    groups = dict(tuple(pdf.groupby("object_id", sort=False)))
+
+    # OR the band bits of each object: keep objects with exactly two bands
+    codes, object_ids = pd.factorize(pdf["object_id"])
+    flags = np.zeros(len(object_ids), dtype=np.int8)
+    bits = pdf["filter"].map(ZTF_FILTER_BITS).fillna(0).to_numpy(dtype=np.int8)
+    np.bitwise_or.at(flags, codes, bits)
+    two_bands = set(object_ids[np.isin(flags, [0b011, 0b101, 0b110])])
+
     if model_name is not None:
         # take the first element of the Series
-        model = get_lite_model(model_name=model_name.to_numpy()[0])
+        model = get_lite_model(model_name=model_name.iloc[0])
     else:
         # Load default pre-trained model
         model = get_lite_model()
 
-    vals = []
-    for candid_ in candid[mask].to_numpy():
-        # one object at a time
-        sub = pdf[pdf["object_id"] == candid_]
-
-        # Need all filters
-        if len(np.unique(sub["filter"])) != 2:
-            vals.append(default)
-            continue
-
-        # one object at a time
+    def gp_features(task):
+        """GP-interpolated and scaled light curve of one object"""
+        candid_, sub = task
         df_gp_mean = generate_gp_all_objects(
             [candid_], sub, pb_wavelengths=ZTF_PB_WAVELENGTHS
         )
@@ -170,16 +196,40 @@ def t2(
         cols = set(ZTF_PB_WAVELENGTHS.keys()) & set(df_gp_mean.columns)
         robust_scale(df_gp_mean, cols)
         X = df_gp_mean[cols]
-        X = np.asarray(X).astype("float32")
-        X = np.expand_dims(X, axis=0)
+        return np.asarray(X).astype("float32")
 
-        y_preds = model.predict(X)
+    candid_arr = candid.to_numpy()[mask_arr]
+    vals = [default] * len(candid_arr)
+    tasks = []
+    idx = []
+    for i, candid_ in enumerate(candid_arr):
+        # one object at a time
+        sub = groups.get(candid_)
 
-        values = y_preds.tolist()
-        predictions = dict(zip(T2_COLS, values[0]))
-        vals.append(predictions)
+        # Need all filters
+        if sub is None or candid_ not in two_bands:
+            continue
 
-    to_return[mask] = vals
+        tasks.append((candid_, sub))
+        idx.append(i)
+
+    if len(tasks) > 0:
+        # GP fits are independent. They run serially unless
+        # FINK_T2_THREADS is set: threads only help if the fits release the GIL
+        nthreads = get_gp_threads()
+        if nthreads == 1:
+            xs = [gp_features(task) for task in tasks]
+        else:
+            with ThreadPoolExecutor(max_workers=nthreads) as executor:
+                xs = list(executor.map(gp_features, tasks))
+
+        # one inference for all objects
+        y_preds = model.predict(np.stack(xs))
+        for j, i in enumerate(idx):
+            vals[i] = dict(zip(T2_COLS, y_preds[j].tolist()))
+
+    for i, val in zip(np.flatnonzero(mask_arr), vals):
+        to_return[i] = val
 
     # return vector of probabilities
     return pd.Series(to_return)
@@ -13,6 +13,8 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 import os
+import warnings
+
 import numpy as np
 import pandas as pd
 
@@ -21,6 +23,7 @@ from tensorflow import keras
 from astronet.metrics import WeightedLogLoss
 
 from fink_science import __file__
+from fink_science.tester import regular_unit_tests
 from fink_utils.xmatch.simbad import return_list_of_eg_host
 
 import tensorflow as tf
@@ -42,6 +45,9 @@ T2_COLS = [
     "SLSN-I",
 ]
 
+# TFLite models already loaded by this Python worker, keyed by their name
+_T2_MODEL_CACHE = {}
+
 
 class LiteModel:
     """Class for lite model"""
@@ -79,10 +85,33 @@ class LiteModel:
         self.output_shape = output_det["shape"]
         self.input_dtype = input_det["dtype"]
         self.output_dtype = output_det["dtype"]
+        self.batch_size = self.input_shape[0]
+        self.batching = True
+
+    def _resize(self, batch_size):
+        """Resize the input tensor to hold `batch_size` samples"""
+        if batch_size != self.batch_size:
+            shape = [batch_size] + list(self.input_shape[1:])
+            self.interpreter.resize_tensor_input(self.input_index, shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
 
     def predict(self, inp):
         inp = inp.astype(self.input_dtype)
         count = inp.shape[0]
+        if self.batching:
+            # run all samples in a single invocation
+            try:
+                self._resize(count)
+                self.interpreter.set_tensor(self.input_index, inp)
+                self.interpreter.invoke()
+                return self.interpreter.get_tensor(self.output_index)
+            except (ValueError, RuntimeError):
+                # the model does not support dynamic batch size
+                self.batching = False
+                self.batch_size = None
+
+        self._resize(self.input_shape[0])
         out = np.zeros((count, self.output_shape[1]), dtype=self.output_dtype)
         for i in range(count):
             self.interpreter.set_tensor(self.input_index, inp[i : i + 1])
@@ -94,9 +123,24 @@ class LiteModel:
 def get_lite_model(
     model_name: str = "quantized-model-GR-noZ-28341-1654269564-0.5.1.dev73+g70f85f8-LL0.836.tflite",
 ):
-    path = os.path.dirname(__file__)
-    model_path = f"{path}/data/models/{model_name}"
-    model = LiteModel.from_file(model_path=model_path)
+    """Load a pre-trained TFLite model for T2, once per Python worker
+
+    Parameters
+    ----------
+    model_name: str
+        File name of the model inside `data/models`
+
+    Returns
+    -------
+    out: LiteModel
+        The model, shared between all subsequent calls with the same name
+    """
+    model = _T2_MODEL_CACHE.get(model_name)
+    if model is None:
+        path = os.path.dirname(__file__)
+        model_path = f"{path}/data/models/{model_name}"
+        model = LiteModel.from_file(model_path=model_path)
+        _T2_MODEL_CACHE[model_name] = model
     return model
 
 
@@ -128,6 +172,44 @@ def get_model(
     return model
 
 
+def get_gp_threads() -> int:
+    """Number of threads for the GP fits of a batch, from `FINK_T2_THREADS`
+
+    Default is 1 (serial). Invalid values (not a positive integer)
+    fall back to 1 with a warning.
+
+    Examples
+    --------
+    >>> os.environ["FINK_T2_THREADS"] = "2"
+    >>> get_gp_threads()
+    2
+    >>> for value in ["0", "four"]:
+    ...     os.environ["FINK_T2_THREADS"] = value
+    ...     with warnings.catch_warnings(record=True) as w:
+    ...         warnings.simplefilter("always")
+    ...         print(get_gp_threads(), len(w))
+    1 1
+    1 1
+    >>> del os.environ["FINK_T2_THREADS"]
+    >>> get_gp_threads()
+    1
+    """
+    value = os.environ.get("FINK_T2_THREADS", "1")
+    try:
+        nthreads = int(value)
+    except ValueError:
+        nthreads = 0
+
+    if nthreads < 1:
+        warnings.warn(
+            "FINK_T2_THREADS must be a positive integer, got {!r}: "
+            "using 1 thread".format(value),
+            stacklevel=2,
+        )
+        return 1
+    return nthreads
+
+
 def apply_selection_cuts_ztf(
     magpsf: pd.Series,
     cdsxmatch: pd.Series,
@@ -178,6 +260,82 @@ def apply_selection_cuts_ztf(
     return mask
 
 
+def drop_invalid_measurements(
+    mask: np.array, magpsf: pd.Series, sigmapsf: pd.Series, *cols: pd.Series
+) -> tuple:
+    """Remove measurements with NaN magnitude or error, for alerts in `mask`
+
+    All measurements are filtered at once on the concatenated arrays,
+    before alerts are exploded into one row per measurement.
+
+    Parameters
+    ----------
+    mask: np.array
+        Boolean array, `True` for alerts to process
+    magpsf, sigmapsf: pd.Series
+        Magnitude from PSF-fit photometry, and 1-sigma error
+        (array of float). Each row contains all measurement values
+        for one alert.
+    *cols: pd.Series
+        Other columns, aligned with `magpsf`, to filter the same way
+
+    Returns
+    -------
+    keep: np.array
+        `mask`, without alerts that have no valid measurements left
+    out: list of pd.Series
+        `magpsf`, `sigmapsf` and `cols` for alerts in `keep` (with
+        their original index), without invalid measurements
+
+    Notes
+    -----
+    Only NaN values of `magpsf` and `sigmapsf` are removed. Unlike the
+    former `dropna()` on the SNANA table, NaN values in `cols` (e.g. dates
+    built from `jd`) are kept.
+
+    Examples
+    --------
+    >>> nan = np.nan
+    >>> magpsf = pd.Series([[18.0, nan, 19.0], [nan, nan], [17.0], [nan]])
+    >>> sigmapsf = pd.Series([[0.1, 0.1, 0.2], [0.1, 0.1], [0.1], [0.1]])
+    >>> fid = pd.Series([[1, 2, 1], [1, 2], [2], [1]])
+
+    Partial NaN (0), all NaN (1), and alert not in the mask (3)
+    >>> mask = np.array([True, True, True, False])
+    >>> keep, (mag, sig, fid_) = drop_invalid_measurements(
+    ...     mask, magpsf, sigmapsf, fid)
+    >>> keep.tolist()
+    [True, False, True, False]
+    >>> mag.index.tolist()
+    [0, 2]
+    >>> [x.tolist() for x in mag], [x.tolist() for x in fid_]
+    ([[18.0, 19.0], [17.0]], [[1, 1], [2]])
+    """
+    idx = np.flatnonzero(mask)
+    mag = magpsf.to_numpy()[idx]
+    lengths = np.fromiter(map(len, mag), dtype=np.int64, count=len(mag))
+    offsets = np.concatenate([[0], np.cumsum(lengths)])
+
+    valid = ~np.isnan(np.concatenate(mag).astype(np.float64))
+    valid &= ~np.isnan(np.concatenate(sigmapsf.to_numpy()[idx]).astype(np.float64))
+
+    # number of valid measurements per alert
+    cumvalid = np.concatenate([[0], np.cumsum(valid)])
+    nvalid = cumvalid[offsets[1:]] - cumvalid[offsets[:-1]]
+
+    keep = np.zeros(len(magpsf), dtype=bool)
+    keep[idx[nvalid > 0]] = True
+    index = magpsf.index[keep]
+
+    out = []
+    for col in (magpsf, sigmapsf, *cols):
+        flat = np.concatenate(col.to_numpy()[idx])[valid]
+        rows = np.split(flat, np.cumsum(nvalid)[:-1])
+        out.append(pd.Series([row for row in rows if len(row) > 0], index=index))
+
+    return keep, out
+
+
 def extract_maxclass(dic: dict) -> str:
     """Extract the class with max probability"""
     vals = list(dic.values())
@@ -188,3 +346,10 @@ def extract_maxclass(dic: dict) -> str:
     else:
         keys = list(dic.keys())
         return keys[np.argmax(vals)]
+
+
+if __name__ == "__main__":
+    """ Execute the test suite """
+
+    # Run the test suite
+    regular_unit_tests(globals())
@@ -53,6 +53,40 @@ def regular_unit_tests(global_args: dict = None, verbose: bool = False):
     sys.exit(doctest.testmod(globs=global_args, verbose=verbose)[0])
 
 
+def assert_arrow_enabled(spark, min_records_per_batch: int = 4096):
+    """Check that the Spark session is tuned for Arrow-based pandas UDFs
+
+    Model-based pandas UDFs (e.g. CATS, T2) have a large fixed cost
+    per batch, so we want Arrow enabled and large Arrow batches.
+
+    Parameters
+    ----------
+    spark: SparkSession
+        Current Spark session
+    min_records_per_batch: int, optional
+        Minimum value expected for
+        `spark.sql.execution.arrow.maxRecordsPerBatch`. Default is 4096.
+
+    Raises
+    ------
+    AssertionError
+        If Arrow is disabled, or if batches are smaller than expected.
+    """
+    enabled = spark.conf.get("spark.sql.execution.arrow.pyspark.enabled", "false")
+    assert str(enabled).lower() == "true", (
+        "spark.sql.execution.arrow.pyspark.enabled must be set to true"
+    )
+
+    nrecords = int(
+        spark.conf.get("spark.sql.execution.arrow.maxRecordsPerBatch", "10000")
+    )
+    assert nrecords >= min_records_per_batch, (
+        "spark.sql.execution.arrow.maxRecordsPerBatch is {} (expected >= {})".format(
+            nrecords, min_records_per_batch
+        )
+    )
+
+
 def spark_unit_tests(global_args: dict = None, verbose: bool = False):
     """Base commands for the Spark unit test suite
 
@@ -84,7 +118,10 @@ def spark_unit_tests(global_args: dict = None, verbose: bool = False):
     ).getOrCreate()
 
     conf = SparkConf()
-    confdic = {"spark.python.daemon.module": "coverage_daemon"}
+    confdic = {
+        "spark.python.daemon.module": "coverage_daemon",
+        "spark.sql.execution.arrow.pyspark.enabled": "true",
+    }
 
     if spark.version.startswith("2"):
         confdic.update({
@@ -109,6 +146,8 @@ def spark_unit_tests(global_args: dict = None, verbose: bool = False):
         .getOrCreate()
     )
 
+    assert_arrow_enabled(spark)
+
     global_args["spark"] = spark
 
     # Numpy introduced non-backward compatible change from v1.14.